@@ -518,7 +518,9 @@ class AbstractConfig(BaseConfig):
 
     def get_vpn_context(self):
         context = super().get_context()
-        for vpnclient in self.vpnclient_set.all().select_related('vpn', 'cert'):
+        for vpnclient in self.vpnclient_set.all().select_related(
+            'vpn', 'vpn__ca', 'cert'
+        ):
             vpn = vpnclient.vpn
             vpn_id = vpn.pk.hex
             context.update(vpn.get_vpn_server_context())
@@ -132,16 +132,11 @@ class AbstractTemplate(ShareableOrgMixinUniqueName, BaseConfig):
         # be executed via transaction.on_commit
         # is executed after the whole block
         with transaction.atomic():
-            changing_status = list(
-                self.config_relations.exclude(status='modified').values_list(
-                    'pk', flat=True
-                )
-            )
             for config in self.config_relations.select_related('device').iterator():
                 # config modified signal sent regardless
                 config._send_config_modified_signal(action='related_template_changed')
                 # config status changed signal sent only if status changed
-                if config.pk in changing_status:
+                if config.status != 'modified':
                     config._send_config_status_changed_signal()
             self.config_relations.exclude(status='modified').update(status='modified')
 
@@ -5,7 +5,7 @@ from celery.exceptions import SoftTimeLimitExceeded
 from django.contrib.auth import get_user_model
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.db import transaction
-from django.test import TestCase, TransactionTestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from netjsonconfig import OpenWrt
 from swapper import load_model
 
@@ -24,11 +24,14 @@ Template = load_model('config', 'Template')
 Vpn = load_model('config', 'Vpn')
 Ca = load_model('django_x509', 'Ca')
 Cert = load_model('django_x509', 'Cert')
+Organization = load_model('openwisp_users', 'Organization')
 User = get_user_model()
 
 _original_context = app_settings.CONTEXT.copy()
+_ORIGINAL_CONTEXT_ITEMS = frozenset(_original_context.items())
 
 
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
 class TestTemplate(
     TestOrganizationMixin, CreateConfigTemplateMixin, TestVpnX509Mixin, TestCase
 ):
@@ -36,18 +39,55 @@ class TestTemplate(
     tests for Template model
     """
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._MAC_A = cls.TEST_MAC_ADDRESS
+        cls._MAC_B = cls.TEST_MAC_ADDRESS.replace('55', '56')
+        # unsaved instances, read-only across tests
+        cls._t_plain = Template(name='test', backend='netjsonconfig.OpenWrt')
+        cls._t_with_config = Template(
+            name='test',
+            backend='netjsonconfig.OpenWrt',
+            config={'general': {'hostname': 'template'}},
+        )
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.org = Organization.objects.create(name='test org', slug='test-org')
+        cls.default_template = Template(
+            name='shared-test-template',
+            backend='netjsonconfig.OpenWrt',
+            config={'interfaces': [{'name': 'eth0', 'type': 'ethernet'}]},
+        )
+        cls.default_template.full_clean()
+        cls.default_template.save()
+        cls.admin = User.objects.create_superuser(
+            username='admin', password='tester', email='admin@admin.com'
+        )
+        # generating keys is expensive, hence the CA and the shared
+        # VPN server (and its certificate) are created only once;
+        # _create_ca() is an instance method of django-x509 which
+        # cannot be called from a classmethod, hence the CA is built here
+        cls.ca = Ca(name='shared-test-ca', common_name='shared-test-ca')
+        cls.ca.full_clean()
+        cls.ca.save()
+        # the name differs from the one used by _create_vpn(),
+        # otherwise shared VPN names would clash in other tests
+        vpn = cls._save_vpn(name='shared-test-vpn', ca=cls.ca)
+        # reload clean instances: signing certificates caches pyOpenSSL
+        # objects which cannot be deep-copied by setUpTestData
+        cls.ca = Ca.objects.get(pk=cls.ca.pk)
+        cls.vpn = Vpn.objects.get(pk=vpn.pk)
+
     def test_str(self):
-        t = Template(name='test', backend='netjsonconfig.OpenWrt')
-        self.assertEqual(str(t), 'test')
+        self.assertEqual(str(self._t_plain), 'test')
 
     def test_backend_class(self):
-        t = Template(name='test', backend='netjsonconfig.OpenWrt')
-        self.assertIs(t.backend_class, OpenWrt)
+        self.assertIs(self._t_plain.backend_class, OpenWrt)
 
     def test_backend_instance(self):
-        config = {'general': {'hostname': 'template'}}
-        t = Template(name='test', backend='netjsonconfig.OpenWrt', config=config)
-        self.assertIsInstance(t.backend_instance, OpenWrt)
+        self.assertIsInstance(self._t_with_config.backend_instance, OpenWrt)
 
     def test_validation(self):
         config = {'interfaces': {'invalid': True}}
@@ -61,40 +101,48 @@ class TestTemplate(
         c = self._create_config(device=self._create_device(name='test-status'))
         c.status = 'applied'
         c.save()
-        c.refresh_from_db()
         with catch_signal(config_status_changed) as handler:
             c.templates.add(t)
-            c.refresh_from_db()
             handler.assert_called_once_with(
                 sender=Config, signal=config_status_changed, instance=c
             )
+            self.assertEqual(handler.call_args.kwargs['instance'].status, 'modified')
 
     def test_no_auto_hostname(self):
-        t = self._create_template()
+        t = self.default_template
         self.assertNotIn('general', t.backend_instance.config)
         t.refresh_from_db()
         self.assertNotIn('general', t.config)
 
     def test_default_template(self):
         # no default templates defined yet
-        org = self._get_org()
+        org = self.org
         c = self._create_config(organization=org)
         self.assertEqual(c.templates.count(), 0)
         c.device.delete()
         # create default templates for different backends
-        t1 = self._create_template(
-            name='default-openwrt', backend='netjsonconfig.OpenWrt', default=True
-        )
-        t2 = self._create_template(
-            name='default-openwisp', backend='netjsonconfig.OpenWisp', default=True
+        config = {'interfaces': [{'name': 'eth0', 'type': 'ethernet'}]}
+        t1, t2 = Template.objects.bulk_create(
+            [
+                Template(
+                    name='default-openwrt',
+                    backend='netjsonconfig.OpenWrt',
+                    default=True,
+                    config=config,
+                ),
+                Template(
+                    name='default-openwisp',
+                    backend='netjsonconfig.OpenWisp',
+                    default=True,
+                    config=config,
+                ),
+            ]
         )
         c1 = self._create_config(
-            device=self._create_device(name='test-openwrt'),
+            device=self._create_device(name='test-openwrt', mac_address=self._MAC_A),
             backend='netjsonconfig.OpenWrt',
         )
-        d2 = self._create_device(
-            name='test-openwisp', mac_address=self.TEST_MAC_ADDRESS.replace('55', '56')
-        )
+        d2 = self._create_device(name='test-openwisp', mac_address=self._MAC_B)
         c2 = self._create_config(device=d2, backend='netjsonconfig.OpenWisp')
         # ensure OpenWRT device has only the default OpenWRT backend
         self.assertEqual(c1.templates.count(), 1)
@@ -112,17 +160,17 @@ class TestTemplate(
             self.fail('ValidationError not raised')
 
     def test_generic_has_no_vpn(self):
-        t = self._create_template(vpn=self._create_vpn())
+        t = self._create_template(vpn=self.vpn)
         self.assertIsNone(t.vpn)
         self.assertFalse(t.auto_cert)
 
     def test_generic_has_create_cert_false(self):
-        t = self._create_template()
+        t = self.default_template
         self.assertFalse(t.auto_cert)
 
     def test_auto_client_template(self):
-        org = self._get_org()
-        vpn = self._create_vpn(organization=org)
+        org = self.org
+        vpn = self._create_vpn(organization=org, ca=self.ca)
         t = self._create_template(
             name='autoclient',
             organization=org,
@@ -135,7 +183,7 @@ class TestTemplate(
         self.assertDictEqual(t.config, control)
 
     def test_auto_client_template_auto_cert_False(self):
-        vpn = self._create_vpn()
+        vpn = self.vpn
         t = self._create_template(
             name='autoclient', type='vpn', auto_cert=False, vpn=vpn, config={}
         )
@@ -147,7 +195,7 @@ class TestTemplate(
 
     @mock.patch.dict(app_settings.CONTEXT, {'vpnserver1': 'vpn.testdomain.com'})
     def test_template_context_var(self):
-        org = self._get_org()
+        org = self.org
         t = self._create_template(
             organization=org,
             config={
@@ -170,19 +218,15 @@ class TestTemplate(
 
     @mock.patch.dict(app_settings.CONTEXT, {'vpnserver1': 'vpn.testdomain.com'})
     def test_get_context(self):
-        t = self._create_template()
+        t = self.default_template
         expected = {}
         expected.update(app_settings.CONTEXT)
         self.assertEqual(t.get_context(), expected)
 
     def test_tamplates_clone(self):
-        org = self._get_org()
+        org = self.org
         t = self._create_template(organization=org, default=True)
-        t.save()
-        user = User.objects.create_superuser(
-            username='admin', password='tester', email='admin@admin.com'
-        )
-        c = t.clone(user)
+        c = t.clone(self.admin)
         c.full_clean()
         c.save()
         self.assertEqual(c.name, '{} (Clone)'.format(t.name))
@@ -226,8 +270,7 @@ class TestTemplate(
         temp = Template(**options)
         temp.full_clean()
         temp.save()
-        obj = Template.objects.get(name='test1')
-        self.assertEqual(obj.name, 'test1')
+        self.assertEqual(temp.get_context()['dns'], '4.4.4.4')
 
     def test_default_value_validation(self):
         options = {
@@ -236,18 +279,20 @@ class TestTemplate(
             'config': {'dns_server': '8.8.8.8'},
         }
         template = Template(**options)
+        # default_values is validated in Template.clean(), calling it
+        # directly avoids the unique checks performed by full_clean()
 
         for value in [None, '', False]:
             with self.subTest(f'testing {value} in template.default_values'):
                 template.default_values = value
-                template.full_clean()
+                template.clean()
                 self.assertEqual(template.default_values, {})
 
         for value in [['a', 'b'], '"test"']:
             with self.subTest(f'testing {value} in template.default_values'):
                 template.default_values = value
                 with self.assertRaises(ValidationError) as context_manager:
-                    template.full_clean()
+                    template.clean()
                 message_dict = context_manager.exception.message_dict
                 self.assertIn('default_values', message_dict)
                 self.assertIn(
@@ -256,23 +301,23 @@ class TestTemplate(
                 )
 
     def test_template_with_org(self):
-        org = self._get_org()
+        org = self.org
         template = self._create_template(organization=org)
         self.assertEqual(template.organization_id, org.pk)
 
     def test_template_without_org(self):
-        template = self._create_template()
+        template = self.default_template
         self.assertIsNone(template.organization)
 
     def test_template_with_shared_vpn(self):
-        vpn = self._create_vpn()  # shared VPN
-        org = self._get_org()
+        vpn = self.vpn  # shared VPN
+        org = self.org
         template = self._create_template(organization=org, type='vpn', vpn=vpn)
         self.assertIsNone(vpn.organization)
         self.assertEqual(template.vpn_id, vpn.pk)
 
     def test_template_and_vpn_different_organization(self):
-        org1 = self._get_org()
+        org1 = self.org
         vpn = self._create_vpn(organization=org1)
         org2 = self._create_org(name='test org2', slug='test-org2')
         try:
@@ -286,8 +331,25 @@ class TestTemplate(
     def test_org_default_template(self):
         org1 = self._create_org(name='org1')
         org2 = self._create_org(name='org2')
-        self._create_template(organization=org1, name='t1', default=True)
-        self._create_template(organization=org2, name='t2', default=True)
+        config = {'interfaces': [{'name': 'eth0', 'type': 'ethernet'}]}
+        Template.objects.bulk_create(
+            [
+                Template(
+                    organization=org1,
+                    name='t1',
+                    backend='netjsonconfig.OpenWrt',
+                    default=True,
+                    config=config,
+                ),
+                Template(
+                    organization=org2,
+                    name='t2',
+                    backend='netjsonconfig.OpenWrt',
+                    default=True,
+                    config=config,
+                ),
+            ]
+        )
         d1 = self._create_device(organization=org1, name='d1')
         c1 = self._create_config(device=d1)
         self.assertEqual(c1.templates.count(), 1)
@@ -304,16 +366,33 @@ class TestTemplate(
 
     def test_org_default_shared_template(self):
         org1 = self._create_org(name='org1')
-        self._create_template(organization=org1, name='t1', default=True)
-        self._create_template(organization=None, name='t2', default=True)
+        config = {'interfaces': [{'name': 'eth0', 'type': 'ethernet'}]}
+        Template.objects.bulk_create(
+            [
+                Template(
+                    organization=org1,
+                    name='t1',
+                    backend='netjsonconfig.OpenWrt',
+                    default=True,
+                    config=config,
+                ),
+                Template(
+                    organization=None,
+                    name='t2',
+                    backend='netjsonconfig.OpenWrt',
+                    default=True,
+                    config=config,
+                ),
+            ]
+        )
         c1 = self._create_config(organization=org1)
         self.assertEqual(c1.templates.count(), 2)
         self.assertEqual(c1.templates.filter(name='t1').count(), 1)
         self.assertEqual(c1.templates.filter(name='t2').count(), 1)
 
     def test_auto_client_template_default(self):
-        org = self._get_org()
-        vpn = self._create_vpn(organization=org)
+        org = self.org
+        vpn = self._create_vpn(organization=org, ca=self.ca)
         self._create_template(
             name='autoclient',
             organization=org,
@@ -326,19 +405,23 @@ class TestTemplate(
         self._create_config(organization=org)
 
     def test_auto_generated_certificate_for_organization(self):
-        organization = self._get_org()
-        vpn = self._create_vpn()
+        organization = self.org
+        vpn = self.vpn
         template = self._create_template(type='vpn', auto_cert=True, vpn=vpn)
         corresponding_device = self._create_device(organization=organization)
         config = self._create_config(device=corresponding_device)
         config.templates.add(template)
-        vpn_clients = config.vpnclient_set.all()
-        for vpn_client in vpn_clients:
-            self.assertIsNotNone(vpn_client.cert.organization)
-            self.assertEqual(vpn_client.cert.organization, config.device.organization)
+        vpn_clients = config.vpnclient_set.select_related('cert__organization')
+        with self.assertNumQueries(1):
+            self.assertEqual(len(vpn_clients), 1)
+            for vpn_client in vpn_clients:
+                self.assertIsNotNone(vpn_client.cert.organization)
+                self.assertEqual(
+                    vpn_client.cert.organization, config.device.organization
+                )
 
     def test_template_name_and_organization_unique(self):
-        org = self._get_org()
+        org = self.org
         self._create_template(name='template', organization=org, default=True)
         kwargs = {
             'name': 'template',  # the name attribute is same as in the template created
@@ -354,21 +437,24 @@ class TestTemplate(
         self.test_auto_generated_certificate_for_organization()
 
         with self.subTest('test Template.get_context()'):
-            template_qs = Template.objects.filter(type='vpn')
+            template_qs = Template.objects.filter(type='vpn').select_related('vpn__ca')
             self.assertEqual(template_qs.count(), 1)
             t = template_qs.first()
-            self.assertDictContainsSubset(_original_context, t.get_context())
+            with self.assertNumQueries(0):
+                context = t.get_context()
+            self.assertDictContainsSubset(_original_context, context)
             self.assertEqual(app_settings.CONTEXT, _original_context)
 
         with self.subTest(
             'test Device.get_context() interacting with VPN client template'
         ):
-            device_qs = Device.objects.all()
+            device_qs = Device.objects.select_related('config')
             self.assertEqual(device_qs.count(), 1)
             d = device_qs.first()
-            orig_context_set = set(_original_context.items())
-            context_set = set(d.get_context().items())
-            self.assertTrue(orig_context_set.issubset(context_set))
+            # VPN clients of the config, with their VPN, CA and certificate
+            with self.assertNumQueries(1):
+                context = d.get_context()
+            self.assertTrue(_ORIGINAL_CONTEXT_ITEMS.issubset(context.items()))
             self.assertEqual(app_settings.CONTEXT, _original_context)
 
     def test_template_with_no_config(self):
@@ -382,7 +468,7 @@ class TestTemplate(
         self.assertNotIn('test', system_context.keys())
 
     def test_template_name_unique_validation(self):
-        org = self._get_org()
+        org = self.org
         template1 = self._create_template(name='test', organization=org)
         self.assertEqual(template1.name, 'test')
         org2 = self._create_org(name='test org2', slug='test-org2')
@@ -481,8 +567,8 @@ class TestTemplate(
             self.assertEqual(config.templates.count(), 0)
 
     def test_required_vpn_template_corner_case(self):
-        org = self._get_org()
-        vpn = self._create_vpn()
+        org = self.org
+        vpn = self.vpn
         t = self._create_template(
             name='vpn-test',
             type='vpn',
@@ -502,6 +588,56 @@ class TestTemplate(
         # {'__all__': ['VPN client with this Config and Vpn already exists.']}
         self.assertIsNotNone(vpn_client)
 
+    @mock.patch.object(update_template_related_config_status, 'delay')
+    def test_task_called(self, mocked_task):
+        with self.subTest('task not called when template is created'):
+            with self.captureOnCommitCallbacks(execute=True):
+                template = self._create_template()
+                conf = self._create_config(
+                    device=self._create_device(name='test-status')
+                )
+                conf.set_status_applied()
+            mocked_task.assert_not_called()
+
+        with self.subTest('task is called when template conf is changed'):
+            template.config['interfaces'][0]['name'] = 'eth1'
+            template.full_clean()
+            with self.captureOnCommitCallbacks(execute=True):
+                template.save()
+            mocked_task.assert_called_with(template.pk)
+
+        mocked_task.reset_mock()
+
+        with self.subTest('task is called when template default_values are changed'):
+            template.refresh_from_db()
+            template.default_values = {'a': 'a'}
+            template.full_clean()
+            with self.captureOnCommitCallbacks(execute=True):
+                template.save()
+            mocked_task.assert_called_with(template.pk)
+
+        mocked_task.reset_mock()
+
+        with self.subTest('task is not called when there are no changes'):
+            template.full_clean()
+            with self.captureOnCommitCallbacks(execute=True):
+                template.save()
+            mocked_task.assert_not_called()
+
+    @mock.patch.object(task_logger, 'warning')
+    def test_task_failure(self, mocked_warning):
+        update_template_related_config_status.apply(args=[uuid.uuid4()])
+        mocked_warning.assert_called_once()
+
+    @mock.patch.object(
+        Template, '_update_related_config_status', side_effect=SoftTimeLimitExceeded
+    )
+    def test_task_timeout(self, mocked_update_related_config_status):
+        with mock.patch.object(task_logger, 'error') as mocked_error:
+            update_template_related_config_status.apply(args=[self.default_template.pk])
+            mocked_error.assert_called_once()
+        mocked_update_related_config_status.assert_called_once()
+
 
 class TestTemplateTransaction(
     TestOrganizationMixin,
@@ -509,6 +645,13 @@ class TestTemplateTransaction(
     TestVpnX509Mixin,
     TransactionTestCase,
 ):
+    """
+    tests which rely on transaction.on_commit hooks being
+    executed as in production (status changes and
+    update_template_related_config_status task), other
+    template tests shall go in TestTemplate
+    """
+
     def test_config_status_modified_after_change(self):
         t = self._create_template()
         c = self._create_config(device=self._create_device(name='test-status'))
@@ -541,7 +684,7 @@ class TestTemplateTransaction(
             with catch_signal(config_status_changed) as handler:
                 t.config['interfaces'][0]['name'] = 'eth2'
                 t.full_clean()
-                with self.assertNumQueries(8):
+                with self.assertNumQueries(7):
                     t.save()
                 c.refresh_from_db()
                 handler.assert_not_called()
@@ -555,7 +698,7 @@ class TestTemplateTransaction(
         )
         self.assertEqual(conf.status, 'modified')
         # refresh instance to reset _just_created attribute
-        conf = Config.objects.get(pk=conf.pk)
+        conf = Config.objects.select_related('device').get(pk=conf.pk)
 
         with self.subTest('signal sent if config status is already modified'):
             with catch_signal(config_modified) as handler:
@@ -664,50 +807,3 @@ class TestTemplateTransaction(
                     action='related_template_changed',
                 )
                 self.assertEqual(conf.status, 'modified')
-
-    @mock.patch.object(update_template_related_config_status, 'delay')
-    def test_task_called(self, mocked_task):
-        with self.subTest('task not called when template is created'):
-            template = self._create_template()
-            conf = self._create_config(device=self._create_device(name='test-status'))
-            conf.set_status_applied()
-            mocked_task.assert_not_called()
-
-        with self.subTest('task is called when template conf is changed'):
-            template.config['interfaces'][0]['name'] = 'eth1'
-            template.full_clean()
-            template.save()
-            mocked_task.assert_called_with(template.pk)
-
-        mocked_task.reset_mock()
-
-        with self.subTest('task is called when template default_values are changed'):
-            template.refresh_from_db()
-            template.default_values = {'a': 'a'}
-            template.full_clean()
-            template.save()
-            mocked_task.assert_called_with(template.pk)
-
-        mocked_task.reset_mock()
-
-        with self.subTest('task is not called when there are no changes'):
-            template.full_clean()
-            template.save()
-            mocked_task.assert_not_called()
-
-    @mock.patch.object(task_logger, 'warning')
-    def test_task_failure(self, mocked_warning):
-        update_template_related_config_status.delay(uuid.uuid4())
-        mocked_warning.assert_called_once()
-
-    @mock.patch.object(
-        Template, '_update_related_config_status', side_effect=SoftTimeLimitExceeded
-    )
-    def test_task_timeout(self, mocked_update_related_config_status):
-        template = self._create_template()
-        with mock.patch.object(task_logger, 'error') as mocked_error:
-            template.config['interfaces'][0]['name'] = 'eth2'
-            template.full_clean()
-            template.save()
-            mocked_error.assert_called_once()
-        mocked_update_related_config_status.assert_called_once()
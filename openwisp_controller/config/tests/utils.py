@@ -113,21 +113,29 @@ UqzLuoNWCyj8KCicbA7tiBxX+2zgQpch8wIBAg==
         'wireguard': [{'name': 'wg0', 'port': 51820}],
     }
 
+    def _create_vpn(self, ca_options={}, **kwargs):
+        if 'ca' not in kwargs:
+            kwargs['ca'] = self._create_ca(**ca_options)
+        return self._save_vpn(**kwargs)
+
+    @classmethod
     @mock.patch(
         'openwisp_controller.config.base.vpn.AbstractVpn.dhparam',
         mock.MagicMock(return_value=_dh),
     )
-    def _create_vpn(self, ca_options={}, **kwargs):
+    def _save_vpn(cls, **kwargs):
+        """
+        creates a VPN without creating a CA, being a classmethod
+        it can be used also in ``setUpTestData``
+        """
         options = dict(
             name='test',
             host='vpn1.test.com',
-            backend=self._BACKENDS['openvpn'],
-            config=self._vpn_config,
-            dh=self._dh,
+            backend=cls._BACKENDS['openvpn'],
+            config=cls._vpn_config,
+            dh=cls._dh,
         )
         options.update(**kwargs)
-        if 'ca' not in options:
-            options['ca'] = self._create_ca(**ca_options)
         vpn = Vpn(**options)
         vpn.full_clean()
         vpn.save()